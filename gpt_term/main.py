@@ -13,14 +13,15 @@ import time
 from configparser import ConfigParser
 from datetime import date, datetime, timedelta
 from importlib.resources import read_text
+from logging.handlers import MemoryHandler, RotatingFileHandler
 from pathlib import Path
 from queue import Queue
 from typing import Dict, List
 
 import pyperclip
 import requests
-import sseclient
-import tiktoken
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from packaging.version import parse as parse_version
 from prompt_toolkit import PromptSession, prompt
 from prompt_toolkit.completion import (Completer, Completion, NestedCompleter,
@@ -33,9 +34,13 @@ from prompt_toolkit.validation import ValidationError, Validator
 from rich import print as rprint
 from rich.console import Console, Group
 from rich.live import Live
-from rich.markdown import Markdown
 from rich.panel import Panel
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from . import __version__
 from .locale import set_lang, get_lang
 import locale
@@ -47,9 +52,14 @@ if not config_path.exists():
     with config_path.open('w') as f:
         f.write(read_text('gpt_term', 'config.ini'))
 
-# 日志记录到 chat.log，注释下面这行可不记录日志
-logging.basicConfig(filename=f'{data_dir}/chat.log', format='%(asctime)s %(name)s: %(levelname)-6s %(message)s',
-                    datefmt='[%Y-%m-%d %H:%M:%S]', level=logging.INFO)
+# 日志记录到 chat.log，注释下面的 addHandler 可不记录日志
+# 日志先缓存在内存中，满 64 条或遇到 WARNING 及以上级别时才写入文件；chat.log 超过 1MB 时轮转
+log_file_handler = RotatingFileHandler(f'{data_dir}/chat.log', maxBytes=1_000_000, backupCount=3, encoding='utf-8')
+log_file_handler.setFormatter(logging.Formatter('%(asctime)s %(name)s: %(levelname)-6s %(message)s',
+                                                datefmt='[%Y-%m-%d %H:%M:%S]'))
+log_memory_handler = MemoryHandler(capacity=64, flushLevel=logging.WARNING, target=log_file_handler)
+logging.getLogger().addHandler(log_memory_handler)
+logging.getLogger().setLevel(logging.INFO)
 
 log = logging.getLogger("chat")
 
@@ -59,6 +69,11 @@ style = Style.from_dict({
     "prompt": "ansigreen",  # 将提示符设置为绿色
 })
 
+supported_langs = ["en", "zh_CN", "jp", "de"]
+
+# 聊天记录文件名中的时间格式，/save 的默认文件名和紧急备份共用
+history_time_format = "%Y-%m-%d_%H,%M,%S"
+
 remote_version = None
 local_version = parse_version(__version__)
 threadlock_remote_version = threading.Lock()
@@ -106,6 +121,17 @@ class ChatGPT:
             "Content-Type": "application/json",
             "Authorization": f"Bearer {api_key}"
         }
+        # 复用同一个 Session，连续请求之间保持 keep-alive，避免每次重新 TCP+TLS 握手
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        # 429 / 5xx 时按指数退避 (遵循 Retry-After) 自动重试，重试用尽后返回最后一次响应，由下面的 4xx 处理显示具体原因
+        # 读取超时不重试 (read=False)，照常抛出 ReadTimeout
+        retry = Retry(total=3, read=False, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=frozenset(["GET", "POST"]), respect_retry_after_header=True, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=5, max_retries=retry)
+        self.session.mount("https://", adapter)
+        # 自定义的 OPENAI_HOST 可能是 http://
+        self.session.mount("http://", adapter)
         self.messages = [
             {"role": "system", "content": f"You are a helpful assistant.\nKnowledge cutoff: 2021-09\nCurrent date: {datetime.now().strftime('%Y-%m-%d')}"}]
         self.model = 'gpt-3.5-turbo'
@@ -116,6 +142,8 @@ class ChatGPT:
         self.total_tokens_spent = 0
         self.current_tokens = count_token(self.messages)
         self.timeout = timeout
+        self.max_context_tokens = 0
+        # 0 means no limit: the full history is sent with every request
         self.title: str = None
         self.gen_title_messages = Queue()
         self.auto_gen_title_background_enable = True
@@ -135,8 +163,8 @@ class ChatGPT:
     def send_request(self, data):
         try:
             with console.status(_("gpt_term.ChatGPT_thinking")):
-                response = requests.post(
-                    self.endpoint, headers=self.headers, data=json.dumps(data), timeout=self.timeout, stream=ChatMode.stream_mode)
+                response = self.session.post(
+                    self.endpoint, json=data, timeout=self.timeout, stream=ChatMode.stream_mode)
             # 匹配4xx错误，显示服务器返回的具体原因
             if response.status_code // 100 == 4:
                 error_msg = response.json()['error']['message']
@@ -163,8 +191,8 @@ class ChatGPT:
         # it SHOULD NOT be triggered or used by not-silent functions
         # it is only used by gen_title_silent now
         try:
-            response = requests.post(
-                self.endpoint, headers=self.headers, data=json.dumps(data), timeout=self.timeout)
+            response = self.session.post(
+                self.endpoint, json=data, timeout=self.timeout)
             # match 4xx error codes
             if response.status_code // 100 == 4:
                 error_msg = response.json()['error']['message']
@@ -181,18 +209,27 @@ class ChatGPT:
             return None
 
     def process_stream_response(self, response: requests.Response):
+        from rich.markdown import Markdown
         reply: str = ""
-        client = sseclient.SSEClient(response)
+        # 服务器以 SSE 逐行推送 `data: {...}`，每收到一行就渲染，不等待完整回复
+        # 按 bytes 分行 (只在 \r / \n 处断开)，再逐行按 UTF-8 解码：
+        # 解码后的 str 分行会在 U+2028 等字符处断开，而 JSON 字符串中可以出现这些字符
         with Live(console=console, auto_refresh=False, vertical_overflow=self.stream_overflow) as live:
             try:
                 rprint("[bold cyan]ChatGPT: ")
-                for event in client.events():
-                    if event.data == '[DONE]':
+                for raw_line in response.iter_lines():
+                    line = raw_line.decode('utf-8')
+                    if not line or not line.startswith("data:"):
+                        continue
+                    event_data = line[len("data:"):].strip()
+                    if event_data == '[DONE]':
                         # finish_reason = part["choices"][0]['finish_reason']
                         break
-                    part = json.loads(event.data)
-                    if "content" in part["choices"][0]["delta"]:
-                        content = part["choices"][0]["delta"]["content"]
+                    part = parse_json(event_data)
+                    if not part["choices"]:
+                        continue
+                    content = part["choices"][0]["delta"].get("content")
+                    if content:
                         reply += content
                         if ChatMode.raw_mode:
                             rprint(content, end="", flush=True),
@@ -208,8 +245,8 @@ class ChatGPT:
         if ChatMode.stream_mode:
             return self.process_stream_response(response)
         else:
-            response_json = response.json()
-            log.debug(f"Response: {response_json}")
+            response_json = parse_json(response.content)
+            log.debug("Response: %s", response_json)
             reply_message: Dict[str, str] = response_json["choices"][0]["message"]
             print_message(reply_message)
             return reply_message
@@ -217,10 +254,9 @@ class ChatGPT:
     def delete_first_conversation(self):
         if len(self.messages) >= 3:
             question = self.messages[1]
-            del self.messages[1]
-            if self.messages[1]['role'] == "assistant":
-                # 如果第二个信息是回答才删除
-                del self.messages[1]
+            # 如果第二个信息是回答才一起删除；问题和回答用一次切片删除，后面的信息只需整体前移一次
+            delete_end = 3 if self.messages[2]['role'] == "assistant" else 2
+            del self.messages[1:delete_end]
             truncated_question = question['content'].split('\n')[0]
             if len(question['content']) > len(truncated_question):
                 truncated_question += "..."
@@ -243,43 +279,73 @@ class ChatGPT:
         os.system('cls' if os.name == 'nt' else 'clear')
         console.print(_('gpt_term.delete_all'))
 
+    def _trim_messages(self, messages: List[Dict[str, str]]):
+        '''保留第一条 (system) 信息和 token 总数不超过 max_context_tokens 的最近若干条信息，只影响本次发送的内容，不删除聊天记录'''
+        if not self.max_context_tokens or len(messages) < 3:
+            return messages
+        tokens_left = self.max_context_tokens - count_token(messages[:1])
+        tail_start = len(messages)
+        while tail_start > 1:
+            tokens_left -= count_token(messages[tail_start - 1:tail_start])
+            if tokens_left < 0:
+                break
+            tail_start -= 1
+        # always send at least the latest question
+        tail_start = min(tail_start, len(messages) - 1)
+        if tail_start > 1:
+            # 截断处落在问题和回答之间时，跳到下一个问题，避免发送缺少问题的回答
+            while tail_start < len(messages) - 1 and messages[tail_start]['role'] != 'user':
+                tail_start += 1
+        return messages[:1] + messages[tail_start:]
+
     def handle(self, message: str):
         try:
-            self.messages.append({"role": "user", "content": message})
+            # 问题只有在收到回复后才和回复一起写入 self.messages，请求失败时无需撤销
+            user_message = {"role": "user", "content": message}
+            payload = self._trim_messages(self.messages + [user_message])
             data = {
                 "model": self.model,
-                "messages": self.messages,
+                "messages": strip_private_keys(payload),
                 "stream": ChatMode.stream_mode,
                 "temperature": self.temperature
             }
             response = self.send_request(data)
             if response is None:
-                self.messages.pop()
-                if self.current_tokens >= self.tokens_limit:
+                # 设置了 /context 时，只有截断后的内容会被发送，按其大小判断是否达到上限
+                context_tokens = count_token(payload) if self.max_context_tokens else self.current_tokens
+                if context_tokens >= self.tokens_limit:
                     if confirm(_('gpt_term.tokens_reached')):
                         self.delete_first_conversation()
                 return
 
             reply_message = self.process_response(response)
             if reply_message is not None:
-                log.info(f"ChatGPT: {reply_message['content']}")
+                log.info("ChatGPT: %s", reply_message['content'])
+                self.messages.append(user_message)
                 self.messages.append(reply_message)
                 self.current_tokens = count_token(self.messages)
-                self.add_total_tokens(self.current_tokens)
+                sent_tokens = count_token(payload) + count_token([reply_message])
+                self.add_total_tokens(sent_tokens)
+                # only the trimmed payload and the reply are charged
 
                 if len(self.messages) == 3 and self.auto_gen_title_background_enable:
                     self.gen_title_messages.put(self.messages[1]['content'])
 
-                if self.tokens_limit - self.current_tokens in range(1, 500):
+                context_tokens = sent_tokens if self.max_context_tokens else self.current_tokens
+                if self.tokens_limit - context_tokens in range(1, 500):
                     console.print(
-                        _("gpt_term.tokens_approaching",token_left=self.tokens_limit - self.current_tokens))
+                        _("gpt_term.tokens_approaching",token_left=self.tokens_limit - context_tokens))
                 # approaching tokens limit (less than 500 left), show info
 
         except Exception as e:
             console.print(
                 _("chat_term.Error_look_log",error_msg=str(e)))
             log.exception(e)
-            self.save_chat_history_urgent()
+            # 出错时问题可能还没写入 self.messages，备份时一并带上
+            if any(m is user_message for m in self.messages):
+                self.save_chat_history_urgent()
+            else:
+                self.save_chat_history_urgent(self.messages + [user_message])
             raise EOFError
 
         return reply_message
@@ -323,11 +389,11 @@ class ChatGPT:
         if response is None:
             self.title = None
             return
-        reply_message = response.json()["choices"][0]["message"]
+        reply_message = parse_json(response.content)["choices"][0]["message"]
         self.title: str = reply_message['content']
         # here: we don't need a lock here for self.title because: the only three places changes or uses chat_gpt.title will never operate together
         # they are: gen_title, gen_title_silent (here), '/save' command
-        log.debug(f"Title background silent generated: {self.title}")
+        log.debug("Title background silent generated: %s", self.title)
 
         messages.append(reply_message)
         self.add_total_tokens(count_token(messages))
@@ -341,7 +407,7 @@ class ChatGPT:
         while True:
             try:
                 content_this_time = self.gen_title_messages.get()
-                log.debug(f"Title Generation Daemon Thread: Working with message \"{content_this_time}\"")
+                log.debug("Title Generation Daemon Thread: Working with message \"%s\"", content_this_time)
                 new_title = self.gen_title_silent(content_this_time)
                 self.gen_title_messages.task_done()
                 time.sleep(0.2)
@@ -363,8 +429,7 @@ class ChatGPT:
 
     def save_chat_history(self, filename):
         try:
-            with open(f"{filename}", 'w', encoding='utf-8') as f:
-                json.dump(self.messages, f, ensure_ascii=False, indent=4)
+            dump_chat_history(strip_private_keys(self.messages), filename)
             console.print(
                 _("gpt_term.save_history_success",filename=filename), highlight=False)
         except Exception as e:
@@ -374,17 +439,19 @@ class ChatGPT:
             self.save_chat_history_urgent()
             return
 
-    def save_chat_history_urgent(self):
-        filename = f'{data_dir}/chat_history_backup_{datetime.now().strftime("%Y-%m-%d_%H,%M,%S")}.json'
-        with open(f"{filename}", 'w', encoding='utf-8') as f:
-            json.dump(self.messages, f, ensure_ascii=False, indent=4)
+    def save_chat_history_urgent(self, messages: List[Dict[str, str]] = None):
+        # messages 默认为 self.messages
+        if messages is None:
+            messages = self.messages
+        filename = f'{data_dir}/chat_history_backup_{time.strftime(history_time_format)}.json'
+        dump_chat_history(strip_private_keys(messages), filename)
         console.print(
             _("gpt_term.save_history_urgent_success",filename=filename), highlight=False)
 
     def send_get(self, url, params=None):
         try:
-            response = requests.get(
-                url, headers=self.headers, timeout=self.timeout, params=params)
+            response = self.session.get(
+                url, timeout=self.timeout, params=params)
         # 匹配4xx错误，显示服务器返回的具体原因
             if response.status_code // 100 == 4:
                 error_msg = response.json()['error']['message']
@@ -410,7 +477,8 @@ class ChatGPT:
         response_subscription = self.send_get(url_subscription)
         if not response_subscription:
             self.credit_total_granted = None
-        response_subscription_json = response_subscription.json()
+            return
+        response_subscription_json = parse_json(response_subscription.content)
         self.credit_total_granted = response_subscription_json["hard_limit_usd"]
         self.credit_plan = response_subscription_json["plan"]["title"]
 
@@ -422,27 +490,26 @@ class ChatGPT:
             url_usage, params=usage_get_params_monthly)
         if not response_monthly_usage:
             self.credit_used_this_month = None
-        self.credit_used_this_month = response_monthly_usage.json()[
+            return
+        self.credit_used_this_month = parse_json(response_monthly_usage.content)[
             "total_usage"] / 100
 
     def get_credit_usage(self):
         url_usage = self.host + "/dashboard/billing/usage"
         try:
-            # get response from /dashborad/billing/subscription for total granted credit
-            fetch_credit_total_granted_thread = threading.Thread(
-                target=self.fetch_credit_total_granted)
-            fetch_credit_total_granted_thread.start()
-
-            # get usage this month
-            fetch_credit_monthly_used_thread = threading.Thread(
-                target=self.fetch_credit_monthly_used, args=(url_usage,))
-            fetch_credit_monthly_used_thread.start()
-
-            # start with 2023-01-01, get 99 days' data per turn
-            usage_get_start_date = date(2023, 1, 1)
-            usage_get_end_date = usage_get_start_date + timedelta(days=99)
-            # 创建线程池，设置最大线程数为5
+            # 创建线程池，设置最大线程数为5，所有查询请求并发发出，复用同一个 Session 的连接池
             with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+                # get response from /dashborad/billing/subscription for total granted credit
+                fetch_credit_total_granted_future = executor.submit(
+                    self.fetch_credit_total_granted)
+
+                # get usage this month
+                fetch_credit_monthly_used_future = executor.submit(
+                    self.fetch_credit_monthly_used, url_usage)
+
+                # start with 2023-01-01, get 99 days' data per turn
+                usage_get_start_date = date(2023, 1, 1)
+                usage_get_end_date = usage_get_start_date + timedelta(days=99)
                 # 提交任务到线程池列表
                 futures = []
                 while usage_get_start_date < date.today():
@@ -454,15 +521,22 @@ class ChatGPT:
                     usage_get_start_date = usage_get_end_date
                     usage_get_end_date = usage_get_start_date + timedelta(days=99)
 
-            fetch_credit_total_granted_thread.join()
-            fetch_credit_monthly_used_thread.join()
+            # leaving the executor waits for every future; if either fetch failed there is nothing to show
+            for future in (fetch_credit_total_granted_future, fetch_credit_monthly_used_future):
+                if future.exception():
+                    console.print(_("gpt_term.Error_message",error_msg=str(future.exception())))
+                    log.error("Fetch credit info failed", exc_info=future.exception())
+                    return None
+            if self.credit_total_granted is None or self.credit_used_this_month is None:
+                # send_get has already printed the error
+                return None
 
             credit_total_used_cent = 0
             # 获取所有线程池任务的返回值
             for future in futures:
                 result = future.result()
                 if result:
-                    credit_total_used_cent += result.json()["total_usage"]
+                    credit_total_used_cent += parse_json(result.content)["total_usage"]
             # get all usage info from 2023-01-01 to now
             self.credit_total_used = credit_total_used_cent / 100
 
@@ -477,6 +551,9 @@ class ChatGPT:
             raise EOFError
         return True
     
+    def close(self):
+        self.session.close()
+
     def set_host(self, host: str):
         self.host = host
         self.endpoint = self.host + "/v1/chat/completions"
@@ -485,6 +562,8 @@ class ChatGPT:
         if self.messages[0]['role'] == 'system':
             old_content = self.messages[0]['content']
             self.messages[0]['content'] = new_content
+            self.messages[0].pop('_tok', None)
+            # content changed, drop the cached token count
             console.print(
                 _("gpt_term.system_prompt_modified",old_content=old_content,new_content=new_content))
             self.current_tokens = count_token(self.messages)
@@ -542,6 +621,21 @@ class ChatGPT:
             return
         console.print(_("gpt_term.timeput_changed",timeout=timeout))
 
+    def set_context_tokens(self, max_context_tokens):
+        try:
+            new_max_context_tokens = int(max_context_tokens)
+        except ValueError:
+            console.print(_("gpt_term.Error_input_int"))
+            return
+        if new_max_context_tokens < 0:
+            console.print(_("gpt_term.Error_input_int"))
+            return
+        self.max_context_tokens = new_max_context_tokens
+        if self.max_context_tokens:
+            console.print(_("gpt_term.context_changed",max_context_tokens=self.max_context_tokens))
+        else:
+            console.print(_("gpt_term.context_disabled"))
+
     def set_temperature(self, temperature):
         try:
             new_temperature = float(temperature)
@@ -578,14 +672,20 @@ class CommandCompleter(Completer):
             '/temperature': None,
             '/title': None,
             '/timeout': None,
+            '/context': None,
             '/undo': None,
             '/delete': {"first", "all"},
             '/reset': None,
-            '/lang' : {"zh_CN","en","jp","de"},
+            '/lang' : set(supported_langs),
             '/version': None,
             '/help': None,
             '/exit': None,
         })
+        # 预先建立 前缀 -> 命令 的索引 (保持上面的命令顺序)，每次按键补全时直接查表
+        self.command_prefix_index: Dict[str, List[str]] = {}
+        for cmd in self.nested_completer.options.keys():
+            for end in range(1, len(cmd) + 1):
+                self.command_prefix_index.setdefault(cmd[:end], []).append(cmd)
 
     def path_filter(self, filename):
         # 路径自动补全，只补全json文件和文件夹
@@ -594,10 +694,9 @@ class CommandCompleter(Completer):
     def get_completions(self, document, complete_event):
         text = document.text_before_cursor
         if text.startswith('/'):
-            for cmd in self.nested_completer.options.keys():
-                # 如果匹配到第一层命令
-                if text in cmd:
-                    yield Completion(cmd, start_position=-len(text))
+            # 如果匹配到第一层命令
+            for cmd in self.command_prefix_index.get(text, ()):
+                yield Completion(cmd, start_position=-len(text))
             # 如果匹配到第n层命令
             if ' ' in text:
                 for sub_cmd in self.nested_completer.get_completions(document, complete_event):
@@ -609,14 +708,56 @@ command_completer = CommandCompleter()
 
 def count_token(messages: List[Dict[str, str]]):
     '''计算 messages 占用的 token
+    每条信息的 token 数缓存在 message['_tok'] 中，每轮对话只需要编码新的信息
     `cl100k_base` 编码适用于: gpt-4, gpt-3.5-turbo, text-embedding-ada-002'''
+    # tiktoken 在首次计算 token 时才导入，加快启动
+    import tiktoken
     encoding = tiktoken.get_encoding("cl100k_base")
     length = 0
     for message in messages:
-        length += len(encoding.encode(str(message)))
+        if '_tok' not in message:
+            message['_tok'] = len(encoding.encode(str(strip_private_keys([message])[0])))
+        length += message['_tok']
     return length
 
 
+def strip_private_keys(messages: List[Dict]):
+    '''去掉 messages 中以下划线开头的本地缓存字段 (如 `_md`, `_tok`)，用于发送请求、计算 token 和保存聊天记录'''
+    return [{k: v for k, v in message.items() if not k.startswith('_')} for message in messages]
+
+
+def dump_chat_history(messages: List[Dict[str, str]], file_path):
+    '''将聊天记录 messages 以 JSON 写入 file_path，安装了 orjson 时使用 orjson 序列化
+    逐条序列化写入 (每条一行)，不为整个聊天记录生成一个大的中间字符串；两种序列化方式写出的格式相同'''
+    if orjson:
+        with open(file_path, 'wb') as f:
+            f.write(b'[')
+            for idx, message in enumerate(messages):
+                f.write(b',\n  ' if idx else b'\n  ')
+                f.write(orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS))
+            f.write(b'\n]' if messages else b']')
+    else:
+        with open(file_path, 'w', encoding='utf-8') as f:
+            f.write('[')
+            for idx, message in enumerate(messages):
+                f.write(',\n  ' if idx else '\n  ')
+                f.write(json.dumps(message, ensure_ascii=False, separators=(',', ':')))
+            f.write('\n]' if messages else ']')
+
+
+def parse_json(data):
+    '''解析 JSON 字符串或 bytes (如 response.content)，安装了 orjson 时使用 orjson 解析'''
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def load_json(file_path):
+    '''从 file_path 读取 JSON，安装了 orjson 时使用 orjson 解析'''
+    with open(file_path, 'rb') as f:
+        return parse_json(f.read())
+
+
 class NumberValidator(Validator):
     def validate(self, document):
         text = document.text
@@ -653,7 +794,12 @@ def print_message(message: Dict[str, str]):
         if ChatMode.raw_mode:
             print(content)
         else:
-            console.print(Markdown(content), new_line_start=True)
+            # 解析好的 Markdown 缓存在 message['_md'] 中，重复显示 (如 /last) 时无需重新解析
+            if '_md' not in message:
+                # rich.markdown 会带入 markdown-it 和 pygments，用到时才导入
+                from rich.markdown import Markdown
+                message['_md'] = Markdown(content)
+            console.print(message['_md'], new_line_start=True)
 
 
 def copy_code(message: Dict[str, str], select_code_idx: int = None):
@@ -668,13 +814,16 @@ def copy_code(message: Dict[str, str], select_code_idx: int = None):
         # if there's only one code, and select_code_idx not given, just copy it
     else:
         if select_code_idx is None:
+            from rich.markdown import Markdown
             console.print(
                 _("gpt_term.code_too_many_found"))
             code_num = 0
+            code_renderables = []
             for codes in code_list:
                 code_num += 1
-                console.print(_("gpt_term.code_num",code_num=code_num))
-                console.print(Markdown(codes))
+                code_renderables.append(_("gpt_term.code_num",code_num=code_num))
+                code_renderables.append(Markdown(codes))
+            console.print(Group(*code_renderables))
 
             select_code_idx = prompt(
                 _("gpt_term.code_select"), style=style, validator=NumberValidator())
@@ -710,7 +859,7 @@ def change_CLI_title(new_title: str):
         print(f"\033]0;{new_title}\007", end='')
         sys.stdout.flush()
         # flush the stdout buffer in order to making the control sequences effective immediately
-    log.debug(f"CLI Title changed to '{new_title}'")
+    log.debug("CLI Title changed to '%s'", new_title)
 
 def get_levenshtein_distance(s1: str, s2: str):
     s1_len = len(s1)
@@ -807,7 +956,7 @@ def handle_command(command: str, chat_gpt: ChatGPT, key_bindings: KeyBindings, c
                 gen_filename = f"{chat_save_perfix}{gen_filename}.json"
             # here: if title is already generated or generating, just use it
             # but title auto generation can also be disabled; therefore when title is not generated then try generating a new one
-            date_filename = f'{chat_save_perfix}{datetime.now().strftime("%Y-%m-%d_%H,%M,%S")}.json'
+            date_filename = f'{chat_save_perfix}{time.strftime(history_time_format)}.json'
             filename = prompt(
                 "Save to: ", default=gen_filename or date_filename, style=style)
         chat_gpt.save_chat_history(filename)
@@ -861,6 +1010,18 @@ def handle_command(command: str, chat_gpt: ChatGPT, key_bindings: KeyBindings, c
         else:
             console.print(_("gpt_term.No_change"))
 
+    elif command.startswith('/context'):
+        args = command.split()
+        if len(args) > 1:
+            new_max_context_tokens = args[1]
+        else:
+            new_max_context_tokens = prompt(
+                _("gpt_term.context_prompt"), default=str(chat_gpt.max_context_tokens), style=style, validator=NumberValidator())
+        if new_max_context_tokens != str(chat_gpt.max_context_tokens):
+            chat_gpt.set_context_tokens(new_max_context_tokens)
+        else:
+            console.print(_("gpt_term.No_change"))
+
     elif command == '/undo':
         if len(chat_gpt.messages) > 2:
             question = chat_gpt.messages.pop()
@@ -932,19 +1093,17 @@ def handle_command(command: str, chat_gpt: ChatGPT, key_bindings: KeyBindings, c
                     most_similar_command = slash_command
                     min_levenshtein_distance = this_levenshtein_distance
         
-        console.print(_("gpt_term.help_uncommand",command=command), end=" ")
+        help_message = _("gpt_term.help_uncommand",command=command) + " "
         if most_similar_command:
-            console.print(_("gpt_term.help_mean_command",most_similar_command=most_similar_command))
-        else:
-            console.print("")
-        console.print(_("gpt_term.help_use_help"))
+            help_message += _("gpt_term.help_mean_command",most_similar_command=most_similar_command)
+        help_message += "\n" + _("gpt_term.help_use_help")
+        console.print(help_message)
 
 
 def load_chat_history(file_path):
     '''从 file_path 加载聊天记录'''
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            chat_history = json.load(f)
+        chat_history = load_json(file_path)
         return chat_history
     except FileNotFoundError:
         console.print(_("gpt_term.load_file_not",file_path=file_path))
@@ -990,7 +1149,7 @@ def get_remote_version():
         log.error("Get remote version failed")
         log.exception(e)
         return
-    log.debug(f"Remote version: {str(remote_version)}")
+    log.debug("Remote version: %s", remote_version)
 
 
 def write_config(config_ini: ConfigParser):
@@ -1025,8 +1184,7 @@ def set_config_by_args(args: argparse.Namespace, config_ini: ConfigParser):
 
 
 def main():
-    global _, supported_langs
-    supported_langs = ["en","zh_CN","jp","de"]
+    global _
     local_lang = locale.getdefaultlocale()[0]
     if local_lang not in supported_langs:
         local_lang = "en"
@@ -1056,7 +1214,7 @@ def main():
     parser.add_argument('-m', '--multi', action='store_true', help=_("gpt_term.help_m"))
     parser.add_argument('-r', '--raw', action='store_true', help=_("gpt_term.help_r"))
     ## 新添加的选项：--lang
-    parser.add_argument('-l','--lang', type=str, choices=['en', 'zh_CN', 'jp', 'de'], help=_("gpt_term.help_lang"))
+    parser.add_argument('-l','--lang', type=str, choices=supported_langs, help=_("gpt_term.help_lang"))
     # normal function args
 
     parser.add_argument('--set-host', metavar='HOST', type=str, help=_("gpt_term.help_set_host"))
@@ -1064,7 +1222,7 @@ def main():
     parser.add_argument('--set-timeout', metavar='SEC', type=int, help=_("gpt_term.help_set_timeout"))
     parser.add_argument('--set-gentitle', metavar='BOOL', type=str, help=_("gpt_term.help_set_gentitle"))
     ## 新添加的选项：--set-lang
-    parser.add_argument('--set-lang', type=str, choices=['en', 'zh_CN', 'jp', 'de'], help=_("gpt_term.help_set_lang"))
+    parser.add_argument('--set-lang', type=str, choices=supported_langs, help=_("gpt_term.help_set_lang"))
     parser.add_argument('--set-saveperfix', metavar='PERFIX', type=str, help=_("gpt_term.help_set_saveperfix"))
     parser.add_argument('--set-loglevel', metavar='LEVEL', type=str, help=_("gpt_term.help_set_loglevel")+'DEBUG, INFO, WARNING, ERROR, CRITICAL')
     # setting args
@@ -1086,7 +1244,7 @@ def main():
     # log level set must be before debug logs, because default log level is INFO, and before new log level being set debug logs will not be written to log file
 
     log.info("GPT-Term start")
-    log.debug(f"Local version: {str(local_version)}")
+    log.debug("Local version: %s", local_version)
     # get local version from pkg resource
 
     check_remote_update_thread = threading.Thread(target=get_remote_version, daemon=True)
@@ -1097,7 +1255,7 @@ def main():
     # if 'key' arg triggered, load the api key from config.ini with the given key-name;
     # otherwise load the api key with the key-name "OPENAI_API_KEY"
     if args.key:
-        log.debug(f"Try loading API key with {args.key} from config.ini")
+        log.debug("Try loading API key with %s from config.ini", args.key)
         api_key = config.get(args.key)
     else:
         api_key = config.get("OPENAI_API_KEY")
@@ -1110,10 +1268,10 @@ def main():
             write_config(config_ini)
 
     api_key_log = api_key[:3] + '*' * (len(api_key) - 7) + api_key[-4:]
-    log.debug(f"Loaded API Key: {api_key_log}")
+    log.debug("Loaded API Key: %s", api_key_log)
 
     api_timeout = config.getfloat("OPENAI_API_TIMEOUT", 30)
-    log.debug(f"API Timeout set to {api_timeout}")
+    log.debug("API Timeout set to %s", api_timeout)
 
     chat_save_perfix = config.get("CHAT_SAVE_PERFIX", "./chat_history_")
 
@@ -1152,7 +1310,7 @@ def main():
             for message in chat_gpt.messages:
                 print_message(message)
             chat_gpt.current_tokens = count_token(chat_gpt.messages)
-            log.info(f"Chat history successfully loaded from: {args.load}")
+            log.info("Chat history successfully loaded from: %s", args.load)
             console.print(
                 _("gpt_term.load_chat_history",load=args.load), highlight=False)
 
@@ -1164,37 +1322,41 @@ def main():
     # 绑定回车事件，达到自定义多行模式的效果
     key_bindings = create_key_bindings()
 
-    while True:
-        try:
-            message = session.prompt(
-                '> ', completer=command_completer, complete_while_typing=True, key_bindings=key_bindings)
+    try:
+        while True:
+            try:
+                message = session.prompt(
+                    '> ', completer=command_completer, complete_while_typing=True, key_bindings=key_bindings)
 
-            if message.startswith('/'):
-                command = message.strip()
-                handle_command(command, chat_gpt,
-                               key_bindings, chat_save_perfix)
-            else:
-                if not message:
-                    continue
+                if message.startswith('/'):
+                    command = message.strip()
+                    handle_command(command, chat_gpt,
+                                   key_bindings, chat_save_perfix)
+                else:
+                    if not message:
+                        continue
 
-                log.info(f"> {message}")
-                chat_gpt.handle(message)
+                    log.info("> %s", message)
+                    chat_gpt.handle(message)
 
-                if message.lower() in ['再见', 'bye', 'goodbye', '结束', 'end', '退出', 'exit', 'quit']:
-                    break
+                    if message.lower() in ['再见', 'bye', 'goodbye', '结束', 'end', '退出', 'exit', 'quit']:
+                        break
 
-        except KeyboardInterrupt:
-            continue
-        except EOFError:
-            console.print(_("gpt_term.exit"))
-            break
+            except KeyboardInterrupt:
+                continue
+            except EOFError:
+                console.print(_("gpt_term.exit"))
+                break
+    finally:
+        chat_gpt.close()
 
-    log.info(f"Total tokens spent: {chat_gpt.total_tokens_spent}")
+    log.info("Total tokens spent: %s", chat_gpt.total_tokens_spent)
     console.print(
         _("gpt_term.spent_token",total_tokens_spent=chat_gpt.total_tokens_spent))
     
     threadlock_remote_version.acquire()
     if remote_version and remote_version > local_version:
+        from rich.markdown import Markdown
         console.print(Panel(Group(
             Markdown(_("gpt_term.upgrade_use_command")),
             Markdown(_("gpt_term.upgrade_see_git"))),